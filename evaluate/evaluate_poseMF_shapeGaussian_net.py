@@ -42,7 +42,8 @@ def evaluate_pose_MF_shapeGaussian_net(pose_shape_model,
     # Instantiate metrics tracker
     metrics_tracker = EvalMetricsTracker(metrics,
                                          save_path=save_path,
-                                         save_per_frame_metrics=save_per_frame_metrics)
+                                         save_per_frame_metrics=save_per_frame_metrics,
+                                         num_total_frames=len(eval_dataset))
     metrics_tracker.initialise_metric_sums()
     metrics_tracker.initialise_per_frame_metric_lists()
 
@@ -89,20 +90,18 @@ def evaluate_pose_MF_shapeGaussian_net(pose_shape_model,
                                                     rot_mult_order='pre')
             target_pose[:, :3] = target_glob_vecs
 
+            # Posed and reposed (zero pose) targets are computed in a single batched SMPL forward pass.
             if target_gender == 'm':
-                target_smpl_output = smpl_model_male(body_pose=target_pose[:, 3:],
-                                                     global_orient=target_pose[:, :3],
-                                                     betas=target_shape)
-                target_reposed_smpl_output = smpl_model_male(betas=target_shape)
+                target_smpl_model = smpl_model_male
             elif target_gender == 'f':
-                target_smpl_output = smpl_model_female(body_pose=target_pose[:, 3:],
-                                                       global_orient=target_pose[:, :3],
-                                                       betas=target_shape)
-                target_reposed_smpl_output = smpl_model_female(betas=target_shape)
-
-            target_vertices = target_smpl_output.vertices
-            target_reposed_vertices = target_reposed_smpl_output.vertices
-            target_joints_h36mlsp = target_smpl_output.joints[:, ALL_JOINTS_TO_H36M_MAP, :][:, H36M_TO_J14, :]
+                target_smpl_model = smpl_model_female
+            target_smpl_output = target_smpl_model(body_pose=torch.cat([target_pose[:, 3:],
+                                                                        torch.zeros_like(target_pose[:, 3:])], dim=0),
+                                                   global_orient=torch.cat([target_pose[:, :3],
+                                                                            torch.zeros_like(target_pose[:, :3])], dim=0),
+                                                   betas=torch.cat([target_shape, target_shape], dim=0))
+            target_vertices, target_reposed_vertices = torch.chunk(target_smpl_output.vertices, 2, dim=0)
+            target_joints_h36mlsp = target_smpl_output.joints[:target_pose.shape[0], ALL_JOINTS_TO_H36M_MAP, :][:, H36M_TO_J14, :]
 
             # ------------------------------- PREDICTIONS -------------------------------
             pred_pose_F, pred_pose_U, pred_pose_S, pred_pose_V, pred_pose_rotmats_mode, \
@@ -204,12 +203,15 @@ def evaluate_pose_MF_shapeGaussian_net(pose_shape_model,
                     pred_silhouette_samples = torch.stack(pred_silhouette_samples, dim=1)  # (1, num samples, img wh, img wh)
 
             # ------------------------------- TRACKING METRICS -------------------------------
-            pred_dict = {'verts': pred_vertices_mode.cpu().detach().numpy(),
-                         'reposed_verts': pred_reposed_vertices_mean.cpu().detach().numpy(),
-                         'joints3D': pred_joints_h36mlsp_mode.cpu().detach().numpy()}
-            target_dict = {'verts': target_vertices.cpu().detach().numpy(),
-                           'reposed_verts': target_reposed_vertices.cpu().detach().numpy(),
-                           'joints3D': target_joints_h36mlsp.cpu().detach().numpy()}
+            # 3D points (and 3D point samples) are passed as torch tensors - the metrics tracker computes 3D point
+            # metrics on-device (apart from the Procrustes analysis SVD, which runs on CPU) and only converts inputs
+            # to numpy for the 2D joint and silhouette metrics.
+            pred_dict = {'verts': pred_vertices_mode,
+                         'reposed_verts': pred_reposed_vertices_mean,
+                         'joints3D': pred_joints_h36mlsp_mode}
+            target_dict = {'verts': target_vertices,
+                           'reposed_verts': target_reposed_vertices,
+                           'joints3D': target_joints_h36mlsp}
 
             if 'joints2D-L2E' in metrics:
                 pred_dict['joints2D'] = pred_joints2d_coco_mode.cpu().detach().numpy()
@@ -219,9 +221,9 @@ def evaluate_pose_MF_shapeGaussian_net(pose_shape_model,
                 target_dict['silhouettes'] = target_silhouette.numpy()
 
             if any('samples_min' in metric for metric in metrics):
-                pred_dict['verts_samples'] = pred_vertices_samples.cpu().detach().numpy()
-                pred_dict['reposed_verts_samples'] = pred_reposed_vertices_samples.cpu().detach().numpy()
-                pred_dict['joints3D_samples'] = pred_joints_h36mlsp_samples.cpu().detach().numpy()
+                pred_dict['verts_samples'] = pred_vertices_samples
+                pred_dict['reposed_verts_samples'] = pred_reposed_vertices_samples
+                pred_dict['joints3D_samples'] = pred_joints_h36mlsp_samples
             if 'joints2Dsamples-L2E' in metrics:
                 pred_dict['joints2Dsamples'] = pred_joints2d_coco_samples[None, :, :, :].cpu().detach().numpy()
             if 'silhouettesamples-IOU' in metrics:
@@ -1,7 +1,176 @@
 import numpy as np
 import os
+import torch
+from functools import partial
 
-from utils.eval_utils import procrustes_analysis_batch, scale_and_translation_transform_batch
+try:
+    import numba
+except ImportError:  # numba is optional - silhouette metrics fall back to numpy if it is not installed.
+    numba = None
+
+from utils.eval_utils import procrustes_analysis_batch, scale_and_translation_transform_batch, \
+    procrustes_analysis_batch_torch, scale_and_translation_transform_batch_torch
+
+
+# Suffixes appended to a base metric name for each alignment variant:
+# raw = no alignment, sc = scale and translation correction, pa = Procrustes analysis.
+ALIGNMENT_VARIANT_SUFFIXES = {'raw': '',
+                              'sc': '-SC',
+                              'pa': '-PA'}
+
+# (base metric name, pred/target dict key, name prefix for returned transformed points)
+POINT_METRIC_FAMILIES = [('PVE', 'verts', 'pred_vertices'),
+                         ('PVE-T', 'reposed_verts', 'pred_reposed_vertices'),
+                         ('MPJPE', 'joints3D', 'pred_joints3D_h36mlsp')]
+
+
+def _rownorm(d):
+    """
+    L2 norm over the last axis of d, as a single einsum contraction rather than np.linalg.norm.
+    :param d: (..., D) array of difference vectors.
+    :return: (...) array of norms.
+    """
+    norm = np.einsum('...i,...i->...', d, d)
+    np.sqrt(norm, out=norm)
+    return norm
+
+
+def _to_numpy(x):
+    """
+    Returns x as a numpy array, copying to host if x is a torch tensor.
+    """
+    if torch.is_tensor(x):
+        return x.cpu().detach().numpy()
+    return x
+
+
+def _reduce_distance_variants(pred, target, variants):
+    """
+    Computes per-point L2 distances between predicted and target points for several alignment variants,
+    estimating each alignment transform once and reducing each variant with a single contraction.
+    :param pred: (B, N, 3) predicted points.
+    :param target: (B, N, 3) target points.
+    :param variants: list of variants to compute, from {'raw', 'sc', 'pa'}.
+    :return: dict mapping each variant to a tuple of aligned pred points (B, N, 3) and per-point errors (B, N).
+    """
+    aligned = {}
+    if 'raw' in variants:
+        aligned['raw'] = pred
+    if 'sc' in variants:
+        aligned['sc'] = scale_and_translation_transform_batch(pred, target)
+    if 'pa' in variants:
+        aligned['pa'] = procrustes_analysis_batch(pred, target)
+
+    outputs = {}
+    for variant, pred_aligned in aligned.items():
+        outputs[variant] = (pred_aligned, _rownorm(pred_aligned - target))
+    return outputs
+
+
+def _reduce_distance_variants_torch(pred, target, variants):
+    """
+    Torch version of _reduce_distance_variants - outputs stay on the same device as the inputs.
+    :param pred: (B, N, 3) predicted points.
+    :param target: (B, N, 3) target points.
+    :param variants: list of variants to compute, from {'raw', 'sc', 'pa'}.
+    :return: dict mapping each variant to a tuple of aligned pred points (B, N, 3) and per-point errors (B, N).
+    """
+    aligned = {}
+    if 'raw' in variants:
+        aligned['raw'] = pred
+    if 'sc' in variants:
+        aligned['sc'] = scale_and_translation_transform_batch_torch(pred, target)
+    if 'pa' in variants:
+        aligned['pa'] = procrustes_analysis_batch_torch(pred, target)
+
+    outputs = {}
+    for variant, pred_aligned in aligned.items():
+        outputs[variant] = (pred_aligned, (pred_aligned - target).norm(dim=-1))
+    return outputs
+
+
+def _samples_min(pred_samples, target, variants):
+    """
+    Computes the mean per-point L2 error of each predicted sample for several alignment variants, and returns
+    the minimum over samples. Each alignment transform is estimated once for the whole stack of samples.
+    :param pred_samples: (S, N, 3) predicted point samples.
+    :param target: (1, N, 3) target points, broadcast over the samples.
+    :param variants: list of variants to compute, from {'raw', 'sc', 'pa'}.
+    :return: dict mapping each variant to the minimum mean per-point error over samples (scalar).
+    """
+    if torch.is_tensor(pred_samples):
+        variant_outputs = _reduce_distance_variants_torch(pred_samples, target, variants)
+        return {variant: error_per_sample.mean(-1, dtype=torch.float32).min()
+                for variant, (_, error_per_sample) in variant_outputs.items()}
+    variant_outputs = _reduce_distance_variants(pred_samples, target, variants)
+    return {variant: error_per_sample.mean(axis=-1, dtype=np.float32).min()
+            for variant, (_, error_per_sample) in variant_outputs.items()}
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def _silhouette_counts_numba(pred, target):
+        """
+        Streams over each (prediction, target) silhouette pair once, counting TP/FP/TN/FN pixels in registers.
+        :param pred: (B, S, P) bool array of S flattened predicted silhouettes per batch element.
+        :param target: (B, P) bool array of flattened target silhouettes.
+        :return: tuple of (B, S) int64 arrays: num_tp, num_fp, num_tn, num_fn.
+        """
+        batch_size, num_samples, num_pixels = pred.shape
+        num_tp = np.zeros((batch_size, num_samples), dtype=np.int64)
+        num_fp = np.zeros((batch_size, num_samples), dtype=np.int64)
+        num_tn = np.zeros((batch_size, num_samples), dtype=np.int64)
+        num_fn = np.zeros((batch_size, num_samples), dtype=np.int64)
+        for k in numba.prange(batch_size * num_samples):
+            b = k // num_samples
+            s = k % num_samples
+            tp = 0
+            fp = 0
+            tn = 0
+            fn = 0
+            for j in range(num_pixels):
+                if pred[b, s, j]:
+                    if target[b, j]:
+                        tp += 1
+                    else:
+                        fp += 1
+                else:
+                    if target[b, j]:
+                        fn += 1
+                    else:
+                        tn += 1
+            num_tp[b, s] = tp
+            num_fp[b, s] = fp
+            num_tn[b, s] = tn
+            num_fn[b, s] = fn
+        return num_tp, num_fp, num_tn, num_fn
+
+
+def _silhouette_counts(pred_silhouettes, target_silhouettes):
+    """
+    Counts true positive, false positive, true negative and false negative pixels for each predicted silhouette.
+    Uses a numba kernel if numba is installed, otherwise only true positives and positive pixels are counted with
+    numpy, and the remaining counts are derived from these.
+    :param pred_silhouettes: (B, S, img_wh, img_wh) S predicted silhouettes per batch element.
+    :param target_silhouettes: (B, img_wh, img_wh) target silhouettes, shared over the S predictions.
+    :return: tuple of (B, S) arrays: num_tp, num_fp, num_tn, num_fn.
+    """
+    batch_size, num_samples = pred_silhouettes.shape[:2]
+    if numba is not None:
+        pred = np.ascontiguousarray(pred_silhouettes, dtype=np.bool_).reshape(batch_size, num_samples, -1)
+        target = np.ascontiguousarray(target_silhouettes, dtype=np.bool_).reshape(batch_size, -1)
+        return _silhouette_counts_numba(pred, target)
+
+    pred = np.asarray(pred_silhouettes, dtype=np.bool_)
+    target = np.asarray(target_silhouettes, dtype=np.bool_)
+    num_pixels = pred.shape[-2] * pred.shape[-1]
+    num_tp = np.count_nonzero(np.logical_and(pred, target[:, None, :, :]), axis=(2, 3))  # (B, S)
+    num_pred_positives = np.count_nonzero(pred, axis=(2, 3))  # (B, S)
+    num_target_positives = np.count_nonzero(target, axis=(1, 2))[:, None]  # (B, 1)
+    num_fp = num_pred_positives - num_tp
+    num_fn = num_target_positives - num_tp
+    num_tn = num_pixels - num_pred_positives - num_target_positives + num_tp
+    return num_tp, num_fp, num_tn, num_fn
 
 
 class EvalMetricsTracker:
@@ -33,40 +202,96 @@ class EvalMetricsTracker:
                  metrics_to_track,
                  img_wh=None,
                  save_path=None,
-                 save_per_frame_metrics=False):
+                 save_per_frame_metrics=False,
+                 num_total_frames=None):
 
         self.metrics_to_track = metrics_to_track
         self.img_wh = img_wh
 
         self.metric_sums = None
         self.total_samples = 0
+        # If the total number of frames to evaluate is known, per-frame metrics are written into preallocated arrays.
+        self.num_total_frames = num_total_frames
+        self._frame_cursor = 0
         self.save_per_frame_metrics = save_per_frame_metrics
         self.save_path = save_path
+
+        # Metric presence flags are computed once here rather than checked against metrics_to_track every batch.
+        self._track = set(metrics_to_track)
+        self._point_metric_variants = {base_metric: [variant for variant, suffix in ALIGNMENT_VARIANT_SUFFIXES.items()
+                                                     if base_metric + suffix in self._track]
+                                       for base_metric, _, _ in POINT_METRIC_FAMILIES}
+        self._samples_min_variants = {base_metric: [variant for variant, suffix in ALIGNMENT_VARIANT_SUFFIXES.items()
+                                                    if base_metric + suffix + '_samples_min' in self._track]
+                                      for base_metric, _, _ in POINT_METRIC_FAMILIES}
+        self._do_samples_min = any(len(variants) > 0 for variants in self._samples_min_variants.values())
+        self._do_joints2D_l2e = 'joints2D-L2E' in self._track
+        self._do_joints2Dsamples_l2e = 'joints2Dsamples-L2E' in self._track
+        self._do_silhouette_iou = 'silhouette-IOU' in self._track
+        self._do_silhouettesamples_iou = 'silhouettesamples-IOU' in self._track
+
+        # Handlers for the enabled metrics only, called in order by update_per_batch.
+        metric_handlers = [(len(self._point_metric_variants[base_metric]) > 0,
+                            partial(self._update_point_metric_family, base_metric, points_key, transformed_points_name))
+                           for base_metric, points_key, transformed_points_name in POINT_METRIC_FAMILIES]
+        metric_handlers += [(self._do_samples_min, self._update_samples_min_metrics),
+                            (self._do_joints2D_l2e, self._update_joints2D_l2e),
+                            (self._do_joints2Dsamples_l2e, self._update_joints2Dsamples_l2e),
+                            (self._do_silhouette_iou, self._update_silhouette_iou),
+                            (self._do_silhouettesamples_iou, self._update_silhouettesamples_iou)]
+        self._metric_handlers = [handler for enabled, handler in metric_handlers if enabled]
         print('\nInitialised metrics tracker.')
 
     def initialise_metric_sums(self):
+        # Sums are accumulated in float64, while per-batch reductions are computed in float32.
         self.metric_sums = {}
         for metric_type in self.metrics_to_track:
             if metric_type == 'silhouette-IOU':
-                self.metric_sums['num_true_positives'] = 0.
-                self.metric_sums['num_false_positives'] = 0.
-                self.metric_sums['num_true_negatives'] = 0.
-                self.metric_sums['num_false_negatives'] = 0.
+                self.metric_sums['num_true_positives'] = np.float64(0.)
+                self.metric_sums['num_false_positives'] = np.float64(0.)
+                self.metric_sums['num_true_negatives'] = np.float64(0.)
+                self.metric_sums['num_false_negatives'] = np.float64(0.)
             elif metric_type == 'silhouettesamples-IOU':
-                self.metric_sums['num_samples_true_positives'] = 0.
-                self.metric_sums['num_samples_false_positives'] = 0.
-                self.metric_sums['num_samples_true_negatives'] = 0.
-                self.metric_sums['num_samples_false_negatives'] = 0.
+                self.metric_sums['num_samples_true_positives'] = np.float64(0.)
+                self.metric_sums['num_samples_false_positives'] = np.float64(0.)
+                self.metric_sums['num_samples_true_negatives'] = np.float64(0.)
+                self.metric_sums['num_samples_false_negatives'] = np.float64(0.)
             elif metric_type == 'joints2Dsamples-L2E':
-                self.metric_sums['num_vis_joints2Dsamples'] = 0.
-                self.metric_sums[metric_type] = 0.
+                self.metric_sums['num_vis_joints2Dsamples'] = np.float64(0.)
+                self.metric_sums[metric_type] = np.float64(0.)
             else:
-                self.metric_sums[metric_type] = 0.
+                self.metric_sums[metric_type] = np.float64(0.)
 
     def initialise_per_frame_metric_lists(self):
         self.per_frame_metrics = {}
         for metric_type in self.metrics_to_track:
-            self.per_frame_metrics[metric_type] = []
+            if self.num_total_frames is None:
+                self.per_frame_metrics[metric_type] = []
+            else:
+                self.per_frame_metrics[metric_type] = None  # Allocated on first write, see _store_per_frame_metric.
+
+    def _store_per_frame_metric(self, metric_type, per_frame, num_input_samples):
+        """
+        Stores a batch of per-frame metrics for metric_type at the current frame cursor.
+        Preallocated arrays are created on first write, as a torch tensor on the same device if the per-frame
+        metrics are torch tensors, such that on-device metrics are not copied to host every batch. Arrays take the dtype
+        of the first per-frame metrics written to them, so saved per-frame metrics keep their dtype.
+        :param metric_type: metric name.
+        :param per_frame: (num_input_samples,) per-frame metrics, or a scalar for samples metrics.
+        :param num_input_samples: number of frames in the batch.
+        """
+        if self.num_total_frames is None:
+            self.per_frame_metrics[metric_type].append(per_frame)
+            return
+        if self.per_frame_metrics[metric_type] is None:
+            if torch.is_tensor(per_frame):
+                self.per_frame_metrics[metric_type] = torch.empty(self.num_total_frames,
+                                                                  dtype=per_frame.dtype,
+                                                                  device=per_frame.device)
+            else:
+                self.per_frame_metrics[metric_type] = np.empty(self.num_total_frames,
+                                                               dtype=np.asarray(per_frame).dtype)
+        self.per_frame_metrics[metric_type][self._frame_cursor:self._frame_cursor + num_input_samples] = per_frame
 
     def update_per_batch(self,
                          pred_dict,
@@ -74,6 +299,7 @@ class EvalMetricsTracker:
                          num_input_samples,
                          return_transformed_points=False,
                          return_per_frame_metrics=False):
+        self._frame_cursor = self.total_samples
         self.total_samples += num_input_samples
 
         if return_transformed_points:
@@ -86,267 +312,171 @@ class EvalMetricsTracker:
             per_frame_metrics_return_dict = None
 
         # -------- Update metrics sums --------
-        if 'PVE' in self.metrics_to_track:
-            pve_batch = np.linalg.norm(pred_dict['verts'] - target_dict['verts'], axis=-1)  # (bsize, 6890) or (num views, 6890)
-            self.metric_sums['PVE'] += np.sum(pve_batch)  # scalar
-            self.per_frame_metrics['PVE'].append(np.mean(pve_batch, axis=-1))  # (bs,) or (num views,)
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['PVE'] = np.mean(pve_batch, axis=-1)
-
-        # Scale and translation correction
-        if 'PVE-SC' in self.metrics_to_track:
-            pred_vertices = pred_dict['verts']  # (bsize, 6890, 3) or (num views, 6890, 3)
-            target_vertices = target_dict['verts']  # (bsize, 6890, 3) or (num views, 6890, 3)
-            pred_vertices_sc = scale_and_translation_transform_batch(pred_vertices, target_vertices)
-            pve_sc_batch = np.linalg.norm(pred_vertices_sc - target_vertices, axis=-1)  # (bs, 6890) or (num views, 6890)
-            self.metric_sums['PVE-SC'] += np.sum(pve_sc_batch)  # scalar
-            self.per_frame_metrics['PVE-SC'].append(np.mean(pve_sc_batch, axis=-1))  # (bs,) or (num views,)
-            if return_transformed_points:
-                transformed_points_return_dict['pred_vertices_sc'] = pred_vertices_sc
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['PVE-SC'] = np.mean(pve_sc_batch, axis=-1)
-
-        # Procrustes analysis
-        if 'PVE-PA' in self.metrics_to_track:
-            pred_vertices = pred_dict['verts']  # (bsize, 6890, 3) or (num views, 6890, 3)
-            target_vertices = target_dict['verts']  # (bsize, 6890, 3) or (num views, 6890, 3)
-            pred_vertices_pa = procrustes_analysis_batch(pred_vertices, target_vertices)
-            pve_pa_batch = np.linalg.norm(pred_vertices_pa - target_vertices, axis=-1)  # (bsize, 6890) or (num views, 6890)
-            self.metric_sums['PVE-PA'] += np.sum(pve_pa_batch)  # scalar
-            self.per_frame_metrics['PVE-PA'].append(np.mean(pve_pa_batch, axis=-1))  # (bs,) or (num views,)
-            if return_transformed_points:
-                transformed_points_return_dict['pred_vertices_pa'] = pred_vertices_pa
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['PVE-PA'] = np.mean(pve_pa_batch, axis=-1)
-
-        # Reposed
-        if 'PVE-T' in self.metrics_to_track:
-            pvet_batch = np.linalg.norm(pred_dict['reposed_verts'] - target_dict['reposed_verts'], axis=-1)  # (bsize, 6890) or (num views, 6890)
-            self.metric_sums['PVE-T'] += np.sum(pvet_batch)  # scalar
-            self.per_frame_metrics['PVE-T'].append(np.mean(pvet_batch, axis=-1))  # (bs,)
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['PVE-T'] = np.mean(pvet_batch, axis=-1)
-
-        # Reposed + Scale and translation correction
-        if 'PVE-T-SC' in self.metrics_to_track:
-            pred_reposed_vertices = pred_dict['reposed_verts']  # (bsize, 6890, 3) or (num views, 6890, 3)
-            target_reposed_vertices = target_dict['reposed_verts']  # (bsize, 6890, 3) or (num views, 6890, 3)
-            pred_reposed_vertices_sc = scale_and_translation_transform_batch(pred_reposed_vertices,
-                                                                             target_reposed_vertices)
-            pvet_sc_batch = np.linalg.norm(pred_reposed_vertices_sc - target_reposed_vertices, axis=-1)  # (bs, 6890) or (num views, 6890)
-            self.metric_sums['PVE-T-SC'] += np.sum(pvet_sc_batch)  # scalar
-            self.per_frame_metrics['PVE-T-SC'].append(np.mean(pvet_sc_batch, axis=-1))  # (bs,) or (num views,)
-            if return_transformed_points:
-                transformed_points_return_dict['pred_reposed_vertices_sc'] = pred_reposed_vertices_sc
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['PVE-T-SC'] = np.mean(pvet_sc_batch, axis=-1)
-
-        if 'MPJPE' in self.metrics_to_track:
-            mpjpe_batch = np.linalg.norm(pred_dict['joints3D'] - target_dict['joints3D'], axis=-1)  # (bsize, 14) or (num views, 14)
-            self.metric_sums['MPJPE'] += np.sum(mpjpe_batch)  # scalar
-            self.per_frame_metrics['MPJPE'].append(np.mean(mpjpe_batch, axis=-1))  # (bs,) or (num views,)
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['MPJPE'] = np.mean(mpjpe_batch, axis=-1)
-
-        # Scale and translation correction
-        if 'MPJPE-SC' in self.metrics_to_track:
-            pred_joints3D_h36mlsp = pred_dict['joints3D']  # (bsize, 14, 3) or (num views, 14, 3)
-            target_joints3D_h36mlsp = target_dict['joints3D']  # (bsize, 14, 3) or (num views, 14, 3)
-            pred_joints3D_h36mlsp_sc = scale_and_translation_transform_batch(pred_joints3D_h36mlsp,
-                                                                             target_joints3D_h36mlsp)
-            mpjpe_sc_batch = np.linalg.norm(pred_joints3D_h36mlsp_sc - target_joints3D_h36mlsp, axis=-1)  # (bsize, 14) or (num views, 14)
-            self.metric_sums['MPJPE-SC'] += np.sum(mpjpe_sc_batch)  # scalar
-            self.per_frame_metrics['MPJPE-SC'].append(np.mean(mpjpe_sc_batch, axis=-1))  # (bs,) or (num views,)
-            if return_transformed_points:
-                transformed_points_return_dict['pred_joints3D_h36mlsp_sc'] = pred_joints3D_h36mlsp_sc
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['MPJPE-SC'] = np.mean(mpjpe_sc_batch, axis=-1)
-
-        # Procrustes analysis
-        if 'MPJPE-PA' in self.metrics_to_track:
-            pred_joints3D_h36mlsp = pred_dict['joints3D']  # (bsize, 14, 3) or (num views, 14, 3)
-            target_joints3D_h36mlsp = target_dict['joints3D']  # (bsize, 14, 3) or (num views, 14, 3)
-            pred_joints3D_h36mlsp_pa = procrustes_analysis_batch(pred_joints3D_h36mlsp,
-                                                                 target_joints3D_h36mlsp)
-            mpjpe_pa_batch = np.linalg.norm(pred_joints3D_h36mlsp_pa - target_joints3D_h36mlsp, axis=-1)  # (bsize, 14) or (num views, 14)
-            self.metric_sums['MPJPE-PA'] += np.sum(mpjpe_pa_batch)  # scalar
-            self.per_frame_metrics['MPJPE-PA'].append(np.mean(mpjpe_pa_batch, axis=-1))  # (bs,) or (num views,)
-            if return_transformed_points:
-                transformed_points_return_dict['pred_joints3D_h36mlsp_pa'] = pred_joints3D_h36mlsp_pa
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['MPJPE-PA'] = np.mean(mpjpe_pa_batch, axis=-1)
-
-        if 'PVE_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pve_per_sample = np.linalg.norm(pred_dict['verts_samples'] - target_dict['verts'], axis=-1)  # (num samples, 6890)
-            min_pve_sample = np.argmin(np.mean(pve_per_sample, axis=-1))
-            pve_samples_min_batch = pve_per_sample[min_pve_sample]
-            self.metric_sums['PVE_samples_min'] += np.sum(pve_samples_min_batch)  # scalar
-            self.per_frame_metrics['PVE_samples_min'].append(np.mean(pve_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        # Scale and translation correction
-        if 'PVE-SC_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pred_vertices_samples = pred_dict['verts_samples']  # (num samples, 6890, 3)
-            target_vertices = np.tile(target_dict['verts'], (pred_vertices_samples.shape[0], 1, 1))  # (num samples, 6890, 3)
-            pred_vertices_samples_sc = scale_and_translation_transform_batch(pred_vertices_samples, target_vertices)
-            pve_sc_per_sample = np.linalg.norm(pred_vertices_samples_sc - target_vertices, axis=-1)  # (num samples, 6890)
-            min_pve_sc_sample = np.argmin(np.mean(pve_sc_per_sample, axis=-1))
-            pve_sc_samples_min_batch = pve_sc_per_sample[min_pve_sc_sample]
-            self.metric_sums['PVE-SC_samples_min'] += np.sum(pve_sc_samples_min_batch)  # scalar
-            self.per_frame_metrics['PVE-SC_samples_min'].append(np.mean(pve_sc_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        # Procrustes analysis
-        if 'PVE-PA_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pred_vertices_samples = pred_dict['verts_samples']  # (num samples, 6890, 3)
-            target_vertices = np.tile(target_dict['verts'], (pred_vertices_samples.shape[0], 1, 1))  # (num samples, 6890, 3)
-            pred_vertices_samples_pa = procrustes_analysis_batch(pred_vertices_samples, target_vertices)
-            pve_pa_per_sample = np.linalg.norm(pred_vertices_samples_pa - target_vertices, axis=-1)  # (num samples, 6890)
-            min_pve_pa_sample = np.argmin(np.mean(pve_pa_per_sample, axis=-1))
-            pve_pa_samples_min_batch = pve_pa_per_sample[min_pve_pa_sample]
-            self.metric_sums['PVE-PA_samples_min'] += np.sum(pve_pa_samples_min_batch)  # scalar
-            self.per_frame_metrics['PVE-PA_samples_min'].append(np.mean(pve_pa_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        # Reposed
-        if 'PVE-T_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pvet_per_sample = np.linalg.norm(pred_dict['reposed_verts_samples'] - target_dict['reposed_verts'],
-                                             axis=-1)  # (num samples, 6890)
-            min_pvet_sample = np.argmin(np.mean(pvet_per_sample, axis=-1))
-            pvet_samples_min_batch = pvet_per_sample[min_pvet_sample]
-            self.metric_sums['PVE-T_samples_min'] += np.sum(pvet_samples_min_batch)  # scalar
-            self.per_frame_metrics['PVE-T_samples_min'].append(np.mean(pvet_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        # Reposed + Scale and translation correction
-        if 'PVE-T-SC_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pred_reposed_vertices_samples = pred_dict['reposed_verts_samples']  # (num samples, 6890, 3)
-            target_reposed_vertices = np.tile(target_dict['reposed_verts'],
-                                              (pred_reposed_vertices_samples.shape[0], 1, 1))  # (num samples, 6890, 3)
-            pred_reposed_vertices_samples_sc = scale_and_translation_transform_batch(pred_reposed_vertices_samples,
-                                                                                     target_reposed_vertices)
-            pvet_sc_per_sample = np.linalg.norm(pred_reposed_vertices_samples_sc - target_reposed_vertices, axis=-1)  # (num samples, 6890)
-            min_pvet_sc_sample = np.argmin(np.mean(pvet_sc_per_sample, axis=-1))
-            pvet_sc_samples_min_batch = pvet_sc_per_sample[min_pvet_sc_sample]
-            self.metric_sums['PVE-T-SC_samples_min'] += np.sum(pvet_sc_samples_min_batch)  # scalar
-            self.per_frame_metrics['PVE-T-SC_samples_min'].append(np.mean(pvet_sc_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        if 'MPJPE_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            mpjpe_per_sample = np.linalg.norm(pred_dict['joints3D_samples'] - target_dict['joints3D'], axis=-1)  # (num samples, 14))
-            min_mpjpe_sample = np.argmin(np.mean(mpjpe_per_sample, axis=-1))
-            mpjpe_samples_min_batch = mpjpe_per_sample[min_mpjpe_sample]
-            self.metric_sums['MPJPE_samples_min'] += np.sum(mpjpe_samples_min_batch)  # scalar
-            self.per_frame_metrics['MPJPE_samples_min'].append(np.mean(mpjpe_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        # Scale and translation correction
-        if 'MPJPE-SC_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pred_joints3D_h36mlsp_samples = pred_dict['joints3D_samples']  # (num samples, 14, 3)
-            target_joints3D_h36mlsp = np.tile(target_dict['joints3D'],
-                                              (pred_joints3D_h36mlsp_samples.shape[0], 1, 1))  # (num samples, 14, 3)
-            pred_joints3D_h36mlsp_sc = scale_and_translation_transform_batch(pred_joints3D_h36mlsp_samples,
-                                                                             target_joints3D_h36mlsp)
-            mpjpe_sc_per_sample = np.linalg.norm(pred_joints3D_h36mlsp_sc - target_joints3D_h36mlsp, axis=-1)  # (num samples, 14)
-            min_mpjpe_sc_sample = np.argmin(np.mean(mpjpe_sc_per_sample, axis=-1))
-            mpjpe_sc_samples_min_batch = mpjpe_sc_per_sample[min_mpjpe_sc_sample]
-            self.metric_sums['MPJPE-SC_samples_min'] += np.sum(mpjpe_sc_samples_min_batch)  # scalar
-            self.per_frame_metrics['MPJPE-SC_samples_min'].append(np.mean(mpjpe_sc_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        # Procrustes analysis
-        if 'MPJPE-PA_samples_min' in self.metrics_to_track:
-            assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
-            pred_joints3D_h36mlsp_samples = pred_dict['joints3D_samples']  # (num samples, 14, 3)
-            target_joints3D_h36mlsp = np.tile(target_dict['joints3D'],
-                                              (pred_joints3D_h36mlsp_samples.shape[0], 1, 1))  # (num samples, 14, 3)
-            pred_joints3D_h36mlsp_pa = procrustes_analysis_batch(pred_joints3D_h36mlsp_samples,
-                                                                 target_joints3D_h36mlsp)
-            mpjpe_pa_per_sample = np.linalg.norm(pred_joints3D_h36mlsp_pa - target_joints3D_h36mlsp, axis=-1)  # (num samples, 14)
-            min_mpjpe_pa_sample = np.argmin(np.mean(mpjpe_pa_per_sample, axis=-1))
-            mpjpe_pa_samples_min_batch = mpjpe_pa_per_sample[min_mpjpe_pa_sample]
-            self.metric_sums['MPJPE-PA_samples_min'] += np.sum(mpjpe_pa_samples_min_batch)  # scalar
-            self.per_frame_metrics['MPJPE-PA_samples_min'].append(np.mean(mpjpe_pa_samples_min_batch, axis=-1))  # (1,) i.e. scalar
-
-        if 'joints2D-L2E' in self.metrics_to_track:
-            pred_joints2D_coco = pred_dict['joints2D']  # (bsize, 17, 2) or (num views, 17, 2)
-            target_joints2D_coco = target_dict['joints2D']  # (bsize, 17, 2) or (num views, 17, 2)
-            joints2D_l2e_batch = np.linalg.norm(pred_joints2D_coco - target_joints2D_coco, axis=-1)  # (bsize, 17) or (num views, 17)
-            self.metric_sums['joints2D-L2E'] += np.sum(joints2D_l2e_batch)  # scalar
-            self.per_frame_metrics['joints2D-L2E'].append(np.mean(joints2D_l2e_batch, axis=-1))  # (bs,) or (num views,)
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['joints2D-L2E'] = np.mean(joints2D_l2e_batch, axis=-1)
-
-        if 'joints2Dsamples-L2E' in self.metrics_to_track:
-            pred_joints2D_coco_samples = pred_dict['joints2Dsamples']  # (bsize, num_samples, 17, 2)
-            target_joints2D_coco = np.tile(target_dict['joints2D'][:, None, :, :], (1, pred_joints2D_coco_samples.shape[1], 1, 1))  # (bsize, num_samples, 17, 2)
-            if 'joints2D_vis' in target_dict.keys():
-                target_joints2d_vis_coco = np.tile(target_dict['joints2D_vis'][:, None, :], (1, pred_joints2D_coco_samples.shape[1], 1))  # (bsize, num_samples, 17)
-                pred_joints2D_coco_samples = pred_joints2D_coco_samples[target_joints2d_vis_coco, :]  # (N, 2)
-                target_joints2D_coco = target_joints2D_coco[target_joints2d_vis_coco, :]  # (N, 2)
-            joints2Dsamples_l2e_batch = np.linalg.norm(pred_joints2D_coco_samples - target_joints2D_coco, axis=-1)  # (N,) or (bsize, num_samples, 17)
-            if 'joints2D_vis' in target_dict.keys():
-                assert joints2Dsamples_l2e_batch.shape[0] == target_joints2d_vis_coco.sum()
-            joints2Dsamples_l2e_batch = joints2Dsamples_l2e_batch.reshape(-1)
-            self.metric_sums['joints2Dsamples-L2E'] += np.sum(joints2Dsamples_l2e_batch)  # scalar
-            self.metric_sums['num_vis_joints2Dsamples'] += joints2Dsamples_l2e_batch.shape[0]
-
-        if 'silhouette-IOU' in self.metrics_to_track:
-            pred_silhouettes = pred_dict['silhouettes']  # (bsize, img_wh, img_wh) or (num views, img_wh, img_wh)
-            target_silhouettes = target_dict['silhouettes']  # (bsize, img_wh, img_wh) or (num views, img_wh, img_wh)
-            true_positive = np.logical_and(pred_silhouettes, target_silhouettes)
-            false_positive = np.logical_and(pred_silhouettes, np.logical_not(target_silhouettes))
-            true_negative = np.logical_and(np.logical_not(pred_silhouettes), np.logical_not(target_silhouettes))
-            false_negative = np.logical_and(np.logical_not(pred_silhouettes), target_silhouettes)
-            num_tp = np.sum(true_positive, axis=(1, 2))  # (bsize,) or (num views,)
-            num_fp = np.sum(false_positive, axis=(1, 2))
-            num_tn = np.sum(true_negative, axis=(1, 2))
-            num_fn = np.sum(false_negative, axis=(1, 2))
-            self.metric_sums['num_true_positives'] += np.sum(num_tp)  # scalar
-            self.metric_sums['num_false_positives'] += np.sum(num_fp)
-            self.metric_sums['num_true_negatives'] += np.sum(num_tn)
-            self.metric_sums['num_false_negatives'] += np.sum(num_fn)
-            iou_per_frame = num_tp/(num_tp + num_fp + num_fn)
-            self.per_frame_metrics['silhouette-IOU'].append(iou_per_frame)  # (bs,) or (num views,)
-            if return_per_frame_metrics:
-                per_frame_metrics_return_dict['silhouette-IOU'] = iou_per_frame
-
-        if 'silhouettesamples-IOU' in self.metrics_to_track:
-            pred_silhouettes_samples = pred_dict['silhouettessamples']  # (bsize, num_samples, img_wh, img_wh)
-            target_silhouettes = np.tile(target_dict['silhouettes'][:, None, :, :], (1, pred_silhouettes_samples.shape[1], 1, 1))  # (bsize, num_samples, img_wh, img_wh)
-            true_positive = np.logical_and(pred_silhouettes_samples, target_silhouettes)
-            false_positive = np.logical_and(pred_silhouettes_samples, np.logical_not(target_silhouettes))
-            true_negative = np.logical_and(np.logical_not(pred_silhouettes_samples), np.logical_not(target_silhouettes))
-            false_negative = np.logical_and(np.logical_not(pred_silhouettes_samples), target_silhouettes)
-            num_tp = np.sum(true_positive, axis=(1, 2))  # (bsize,) or (num views,)
-            num_fp = np.sum(false_positive, axis=(1, 2))
-            num_tn = np.sum(true_negative, axis=(1, 2))
-            num_fn = np.sum(false_negative, axis=(1, 2))
-            self.metric_sums['num_samples_true_positives'] += np.sum(num_tp)  # scalar
-            self.metric_sums['num_samples_false_positives'] += np.sum(num_fp)
-            self.metric_sums['num_samples_true_negatives'] += np.sum(num_tn)
-            self.metric_sums['num_samples_false_negatives'] += np.sum(num_fn)
+        # Entries of pred_dict/target_dict may be numpy arrays or torch tensors. The 3D point metrics are computed
+        # in torch for torch inputs, all other metrics convert their inputs to numpy as needed.
+        # Handlers do not modify the tracker - each returns its updates, which are merged here.
+        # Returned per-frame metrics and transformed points are always numpy arrays, as metrics computed from torch
+        # inputs may be torch tensors on the input device.
+        for handler in self._metric_handlers:
+            metric_sum_updates, per_frame_updates, transformed_points = handler(pred_dict,
+                                                                                target_dict,
+                                                                                num_input_samples)
+            for key, value in metric_sum_updates.items():
+                if torch.is_tensor(value) and not torch.is_tensor(self.metric_sums[key]):
+                    # Sums of metrics computed from torch inputs are accumulated in a float64 tensor on the same device.
+                    self.metric_sums[key] = torch.tensor(self.metric_sums[key], dtype=torch.float64, device=value.device)
+                self.metric_sums[key] += value
+            for metric_type, per_frame in per_frame_updates.items():
+                self._store_per_frame_metric(metric_type, per_frame, num_input_samples)
+                if per_frame_metrics_return_dict is not None and 'samples' not in metric_type:
+                    per_frame_metrics_return_dict[metric_type] = _to_numpy(per_frame)
+            if transformed_points_return_dict is not None:
+                for name, points in transformed_points.items():
+                    transformed_points_return_dict[name] = _to_numpy(points)
 
         return transformed_points_return_dict, per_frame_metrics_return_dict
 
+    def _update_point_metric_family(self,
+                                    base_metric,
+                                    points_key,
+                                    transformed_points_name,
+                                    pred_dict,
+                                    target_dict,
+                                    num_input_samples):
+        # The alignment transforms and distances for all tracked variants (raw/SC/PA) of a family of 3D point
+        # metrics share a base (pred, target) pair, so they are computed together.
+        # If the points are given as torch tensors, these metrics are computed and accumulated on-device, and only
+        # copied to host in compute_final_metrics (the Procrustes analysis SVD still runs on CPU).
+        metric_sum_updates = {}
+        per_frame_updates = {}
+        transformed_points = {}
+        variants = self._point_metric_variants[base_metric]
+        if torch.is_tensor(pred_dict[points_key]):
+            variant_outputs = _reduce_distance_variants_torch(pred_dict[points_key],
+                                                              target_dict[points_key],
+                                                              variants)
+        else:
+            variant_outputs = _reduce_distance_variants(pred_dict[points_key],
+                                                        target_dict[points_key],
+                                                        variants)
+        for variant, (pred_points_aligned, error_batch) in variant_outputs.items():
+            metric_type = base_metric + ALIGNMENT_VARIANT_SUFFIXES[variant]
+            if torch.is_tensor(error_batch):
+                per_frame = error_batch.mean(-1, dtype=torch.float32)  # (bs,) or (num views,)
+                error_sum = per_frame.sum(dtype=torch.float64) * error_batch.shape[-1]
+            else:
+                per_frame = error_batch.mean(axis=-1, dtype=np.float32)  # (bs,) or (num views,)
+                error_sum = per_frame.sum(dtype=np.float64) * error_batch.shape[-1]
+            metric_sum_updates[metric_type] = error_sum  # scalar
+            per_frame_updates[metric_type] = per_frame
+            if variant != 'raw':
+                transformed_points[transformed_points_name + '_' + variant] = pred_points_aligned
+        return metric_sum_updates, per_frame_updates, transformed_points
+
+    def _update_samples_min_metrics(self,
+                                    pred_dict,
+                                    target_dict,
+                                    num_input_samples):
+        assert num_input_samples == 1, "Batch size must be 1 for min samples metrics!"
+        # The raw/SC/PA variants of each family are computed together over the stack of samples.
+        metric_sum_updates = {}
+        per_frame_updates = {}
+        for base_metric, points_key, _ in POINT_METRIC_FAMILIES:
+            variants = self._samples_min_variants[base_metric]
+            if len(variants) == 0:
+                continue
+            pred_points_samples = pred_dict[points_key + '_samples']  # (num samples, N, 3)
+            min_errors = _samples_min(pred_points_samples,
+                                      target_dict[points_key],  # (1, N, 3) - broadcasts over samples
+                                      variants)
+            for variant, min_error in min_errors.items():
+                metric_type = base_metric + ALIGNMENT_VARIANT_SUFFIXES[variant] + '_samples_min'
+                if torch.is_tensor(min_error):
+                    metric_sum_updates[metric_type] = min_error.to(torch.float64) * pred_points_samples.shape[1]  # scalar
+                else:
+                    metric_sum_updates[metric_type] = np.float64(min_error) * pred_points_samples.shape[1]  # scalar
+                per_frame_updates[metric_type] = min_error  # (1,) i.e. scalar
+        return metric_sum_updates, per_frame_updates, {}
+
+    def _update_joints2D_l2e(self,
+                             pred_dict,
+                             target_dict,
+                             num_input_samples):
+        pred_joints2D_coco = _to_numpy(pred_dict['joints2D'])  # (bsize, 17, 2) or (num views, 17, 2)
+        target_joints2D_coco = _to_numpy(target_dict['joints2D'])  # (bsize, 17, 2) or (num views, 17, 2)
+        joints2D_l2e_batch = _rownorm(pred_joints2D_coco - target_joints2D_coco)  # (bsize, 17) or (num views, 17)
+        joints2D_l2e_per_frame = np.mean(joints2D_l2e_batch, axis=-1, dtype=np.float32)  # (bs,) or (num views,)
+        metric_sum_updates = {'joints2D-L2E': np.sum(joints2D_l2e_per_frame, dtype=np.float64) * joints2D_l2e_batch.shape[-1]}  # scalar
+        return metric_sum_updates, {'joints2D-L2E': joints2D_l2e_per_frame}, {}
+
+    def _update_joints2Dsamples_l2e(self,
+                                    pred_dict,
+                                    target_dict,
+                                    num_input_samples):
+        pred_joints2D_coco_samples = _to_numpy(pred_dict['joints2Dsamples'])  # (bsize, num_samples, 17, 2)
+        target_joints2D_coco = _to_numpy(target_dict['joints2D'])[:, None, :, :]  # (bsize, 1, 17, 2) - broadcasts over samples
+        joints2Dsamples_l2e_batch = _rownorm(pred_joints2D_coco_samples - target_joints2D_coco)  # (bsize, num_samples, 17)
+        if 'joints2D_vis' in target_dict.keys():
+            # Errors of invisible joints are zeroed by the visibility mask, rather than gathering visible joints.
+            target_joints2d_vis_coco = _to_numpy(target_dict['joints2D_vis'])[:, None, :]  # (bsize, 1, 17)
+            joints2Dsamples_l2e_batch *= target_joints2d_vis_coco
+            num_vis_joints2Dsamples = np.sum(target_joints2d_vis_coco) * pred_joints2D_coco_samples.shape[1]
+        else:
+            num_vis_joints2Dsamples = joints2Dsamples_l2e_batch.size
+        metric_sum_updates = {'joints2Dsamples-L2E': np.sum(joints2Dsamples_l2e_batch, dtype=np.float64),  # scalar
+                              'num_vis_joints2Dsamples': num_vis_joints2Dsamples}
+        return metric_sum_updates, {}, {}
+
+    def _update_silhouette_iou(self,
+                               pred_dict,
+                               target_dict,
+                               num_input_samples):
+        pred_silhouettes = _to_numpy(pred_dict['silhouettes'])  # (bsize, img_wh, img_wh) or (num views, img_wh, img_wh)
+        target_silhouettes = _to_numpy(target_dict['silhouettes'])  # (bsize, img_wh, img_wh) or (num views, img_wh, img_wh)
+        num_tp, num_fp, num_tn, num_fn = [counts[:, 0] for counts in
+                                          _silhouette_counts(pred_silhouettes[:, None, :, :],
+                                                             target_silhouettes)]  # (bsize,) or (num views,)
+        metric_sum_updates = {'num_true_positives': np.sum(num_tp),  # scalar
+                              'num_false_positives': np.sum(num_fp),
+                              'num_true_negatives': np.sum(num_tn),
+                              'num_false_negatives': np.sum(num_fn)}
+        iou_per_frame = num_tp/(num_tp + num_fp + num_fn)  # (bs,) or (num views,)
+        return metric_sum_updates, {'silhouette-IOU': iou_per_frame}, {}
+
+    def _update_silhouettesamples_iou(self,
+                                      pred_dict,
+                                      target_dict,
+                                      num_input_samples):
+        pred_silhouettes_samples = _to_numpy(pred_dict['silhouettessamples'])  # (bsize, num_samples, img_wh, img_wh)
+        target_silhouettes = _to_numpy(target_dict['silhouettes'])  # (bsize, img_wh, img_wh)
+        num_tp, num_fp, num_tn, num_fn = _silhouette_counts(pred_silhouettes_samples,
+                                                            target_silhouettes)  # (bsize, num_samples)
+        metric_sum_updates = {'num_samples_true_positives': np.sum(num_tp),  # scalar
+                              'num_samples_false_positives': np.sum(num_fp),
+                              'num_samples_true_negatives': np.sum(num_tn),
+                              'num_samples_false_negatives': np.sum(num_fn)}
+        return metric_sum_updates, {}, {}
+
     def compute_final_metrics(self):
+        # Sums accumulated on-device from torch inputs are copied to host here, once.
+        metric_sums = {key: _to_numpy(value) for key, value in self.metric_sums.items()}
         final_metrics = {}
         for metric_type in self.metrics_to_track:
             mult = 1.
             if metric_type == 'silhouette-IOU':
-                iou = self.metric_sums['num_true_positives'] / \
-                      (self.metric_sums['num_true_positives'] +
-                       self.metric_sums['num_false_negatives'] +
-                       self.metric_sums['num_false_positives'])
+                iou = metric_sums['num_true_positives'] / \
+                      (metric_sums['num_true_positives'] +
+                       metric_sums['num_false_negatives'] +
+                       metric_sums['num_false_positives'])
                 final_metrics['silhouette-IOU'] = iou
             elif metric_type == 'silhouettesamples-IOU':
-                iou = self.metric_sums['num_samples_true_positives'] / \
-                      (self.metric_sums['num_samples_true_positives'] +
-                       self.metric_sums['num_samples_false_negatives'] +
-                       self.metric_sums['num_samples_false_positives'])
+                iou = metric_sums['num_samples_true_positives'] / \
+                      (metric_sums['num_samples_true_positives'] +
+                       metric_sums['num_samples_false_negatives'] +
+                       metric_sums['num_samples_false_positives'])
                 final_metrics['silhouettesamples-IOU'] = iou
             elif metric_type == 'joints2Dsamples-L2E':
-                joints2Dsamples_l2e = self.metric_sums['joints2Dsamples-L2E'] / self.metric_sums['num_vis_joints2Dsamples']
+                joints2Dsamples_l2e = metric_sums['joints2Dsamples-L2E'] / metric_sums['num_vis_joints2Dsamples']
                 final_metrics[metric_type] = joints2Dsamples_l2e
             else:
                 if 'PVE' in metric_type:
@@ -357,12 +487,17 @@ class EvalMetricsTracker:
                     mult = 1000.
                 elif 'joints2D' in metric_type:
                     num_per_sample = 17
-                final_metrics[metric_type] = self.metric_sums[metric_type] / (self.total_samples * num_per_sample)
+                final_metrics[metric_type] = metric_sums[metric_type] / (self.total_samples * num_per_sample)
 
             print(metric_type, '{:.2f}'.format(final_metrics[metric_type] * mult))
 
         if self.save_per_frame_metrics:
             for metric_type in self.metrics_to_track:
                 if 'samples' not in metric_type:
-                    per_frame = np.concatenate(self.per_frame_metrics[metric_type], axis=0)
+                    if self.num_total_frames is None:
+                        per_frame = np.concatenate([_to_numpy(frame_metrics)
+                                                    for frame_metrics in self.per_frame_metrics[metric_type]],
+                                                   axis=0)
+                    else:
+                        per_frame = _to_numpy(self.per_frame_metrics[metric_type][:self.total_samples])
                     np.save(os.path.join(self.save_path, metric_type+'_per_frame.npy'), per_frame)
\ No newline at end of file
@@ -60,10 +60,86 @@ def compute_similarity_transform(S1, S2):
 
 
 def procrustes_analysis_batch(S1, S2):
-    """Batched version of compute_similarity_transform."""
-    S1_hat = np.zeros_like(S1)
-    for i in range(S1.shape[0]):
-        S1_hat[i] = compute_similarity_transform(S1[i], S2[i])
+    """
+    Batched version of compute_similarity_transform.
+    All per-sample SVDs are computed by a single batched np.linalg.svd call.
+    :param S1: (batch_size, N, 3) batch of N 3D points to transform.
+    :param S2: (batch_size, N, 3) batch of N reference 3D points.
+    :return: S1 transformed
+    """
+    # 1. Remove mean.
+    mu1 = S1.mean(axis=1, keepdims=True)
+    mu2 = S2.mean(axis=1, keepdims=True)
+    X1 = S1 - mu1
+    X2 = S2 - mu2
+
+    # 2. Compute variance of X1 used for scale.
+    var1 = np.sum(X1 ** 2, axis=(1, 2))
+
+    # 3. The outer product of X1 and X2.
+    K = np.matmul(X1.transpose(0, 2, 1), X2)  # (batch_size, 3, 3)
+
+    # 4. Solution that Maximizes trace(R'K) is R=U*V', where U, V are
+    # singular vectors of K.
+    U, s, Vh = np.linalg.svd(K)
+    V = Vh.transpose(0, 2, 1)
+    # Construct Z that fixes the orientation of R to get det(R)=1.
+    Z = np.tile(np.eye(U.shape[-1]), (K.shape[0], 1, 1))
+    Z[:, -1, -1] *= np.sign(np.linalg.det(np.matmul(U, Vh)))
+    # Construct R.
+    R = np.matmul(V, np.matmul(Z, U.transpose(0, 2, 1)))
+
+    # 5. Recover scale.
+    scale = np.trace(np.matmul(R, K), axis1=1, axis2=2) / var1
+
+    # 6. Recover translation.
+    t = mu2 - scale[:, None, None] * np.matmul(mu1, R.transpose(0, 2, 1))
+
+    # 7. Error:
+    S1_hat = scale[:, None, None] * np.matmul(S1, R.transpose(0, 2, 1)) + t
+
+    return S1_hat.astype(S1.dtype, copy=False)
+
+
+def procrustes_analysis_batch_torch(S1, S2):
+    """
+    Batched torch version of compute_similarity_transform.
+    The (batch_size, 3, 3) SVD is computed on CPU, like the SVDs in models/poseMF_shapeGaussian_net.py, so this
+    synchronises with the device if the inputs are on GPU.
+    :param S1: (batch_size, N, 3) batch of N 3D points to transform.
+    :param S2: (batch_size, N, 3) batch of N reference 3D points.
+    :return: S1 transformed
+    """
+    # 1. Remove mean.
+    mu1 = torch.mean(S1, dim=1, keepdim=True)
+    mu2 = torch.mean(S2, dim=1, keepdim=True)
+    X1 = S1 - mu1
+    X2 = S2 - mu2
+
+    # 2. Compute variance of X1 used for scale.
+    var1 = torch.sum(X1 ** 2, dim=(1, 2))
+
+    # 3. The outer product of X1 and X2.
+    K = torch.matmul(X1.transpose(1, 2), X2)  # (batch_size, 3, 3)
+
+    # 4. Solution that Maximizes trace(R'K) is R=U*V', where U, V are
+    # singular vectors of K.
+    U, s, V = torch.svd(K.cpu())
+    # Construct Z that fixes the orientation of R to get det(R)=1.
+    Z = torch.eye(U.shape[-1], dtype=K.dtype).repeat(K.shape[0], 1, 1)
+    Z[:, -1, -1] *= torch.sign(torch.det(torch.matmul(U, V.transpose(1, 2))))
+    # Construct R.
+    R = torch.matmul(V, torch.matmul(Z, U.transpose(1, 2))).to(K.device)
+
+    # 5. Recover scale.
+    scale = torch.diagonal(torch.matmul(R, K), dim1=1, dim2=2).sum(dim=-1) / var1
+
+    # 6. Recover translation.
+    t = mu2 - scale[:, None, None] * torch.matmul(mu1, R.transpose(1, 2))
+
+    # 7. Error:
+    S1_hat = scale[:, None, None] * torch.matmul(S1, R.transpose(1, 2)) + t
+
     return S1_hat
 
 